@@ -1,8 +1,21 @@
+import asyncio
+import hashlib
+import io
+import re
 import streamlit as st
-from openai import OpenAI  # Updated import per migration
-import pdfplumber
-import docx
-import json
+from openai import AsyncOpenAI, OpenAI  # Updated import per migration
+import orjson
+import zipfile
+import lxml.etree as ET
+import numpy as np
+import tiktoken
+from partial_json_parser import Allow, loads as loads_partial_json
+
+import llm_cache
+import pdf_text
+
+# gpt-4o-mini's tokenizer; loaded once per process.
+ENC = tiktoken.get_encoding("o200k_base")
 
 # ---- Page Configuration ----
 st.set_page_config(page_title="Frågekonstruktören", layout="centered")
@@ -10,11 +23,11 @@ st.title("Frågekonstruktören")
 
 # ---- Reset Button ----
 if st.button("Starta om"):
-    # Clear session state keys except the API key
-    for key in ["faktabas", "larandemal_och_indikatorer", "mcqs"]:
+    # Clear session state keys except the API key. This runs before main(), so
+    # the rest of this script run already renders the cleared state; no extra
+    # rerun is needed.
+    for key in ["faktabas", "faktabas_index", "faktabas_index_key", "larandemal_och_indikatorer", "mcqs"]:
         st.session_state.pop(key, None)
-    if hasattr(st, "experimental_rerun"):
-        st.experimental_rerun()
 
 # ---- Utility Functions ----
 def get_api_key():
@@ -26,114 +39,622 @@ def get_api_key():
     )
     return st.session_state["api_key"]
 
-def extract_text(file) -> str:
-    """Extract text from an uploaded .txt, .pdf, or .docx file."""
-    text = ""
+W_NS = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+MC_NS = "{http://schemas.openxmlformats.org/markup-compatibility/2006}"
+
+def _extract_docx_paragraphs(file_bytes: bytes) -> list[str]:
+    """
+    Read paragraph texts straight from word/document.xml.
+
+    Much faster and lighter than building python-docx's full object model when
+    only the text is needed. Tabs and line breaks are kept as in python-docx.
+    Unlike python-docx's doc.paragraphs, this includes paragraphs inside table
+    cells and text boxes, so their text becomes part of the fact base. Word
+    stores each text box twice, as an mc:Choice and a VML mc:Fallback; only the
+    Choice copy is read.
+    """
     try:
-        if file.name.endswith(".txt"):
-            text = file.getvalue().decode("utf-8")
-        elif file.name.endswith(".pdf"):
-            with pdfplumber.open(file) as pdf:
-                for page in pdf.pages:
-                    page_text = page.extract_text()
-                    if page_text:
-                        text += page_text + "\n"
-        elif file.name.endswith(".docx"):
-            doc = docx.Document(file)
-            for para in doc.paragraphs:
-                text += para.text + "\n"
+        with zipfile.ZipFile(io.BytesIO(file_bytes)) as archive:
+            xml = archive.read("word/document.xml")
+    except KeyError:
+        raise ValueError("word/document.xml saknas i .docx-filen") from None
+
+    paragraphs = []
+    for _, para in ET.iterparse(io.BytesIO(xml), tag=f"{W_NS}p"):
+        if next(para.iterancestors(f"{MC_NS}Fallback"), None) is not None:
+            para.clear()
+            continue
+        pieces = []
+        for el in para.iter(f"{W_NS}t", f"{W_NS}tab", f"{W_NS}br"):
+            if el.tag == f"{W_NS}t":
+                pieces.append(el.text or "")
+            else:
+                pieces.append("\t" if el.tag == f"{W_NS}tab" else "\n")
+        paragraphs.append("".join(pieces))
+        para.clear()
+    return paragraphs
+
+@st.cache_data(max_entries=32)
+def _extract_text_cached(file_bytes: bytes, name: str) -> str:
+    """Extract text from file contents; memoized on the bytes so reruns skip parsing."""
+    parts: list[str] = []
+    try:
+        if name.endswith(".txt"):
+            parts.append(file_bytes.decode("utf-8"))
+        elif name.endswith(".pdf"):
+            parts.extend(pdf_text.extract_pages(file_bytes))
+            if not any(parts):
+                st.warning("PDF-filen verkar vara skannad och saknar textlager – OCR krävs.")
+        elif name.endswith(".docx"):
+            parts.extend(_extract_docx_paragraphs(file_bytes))
     except Exception as e:
         st.error(f"Fel vid extrahering av text: {e}")
-    return text
+    # Join once instead of growing a string per page/paragraph (quadratic copying).
+    return "\n".join(p for p in parts if p)
+
+def extract_text(file) -> str:
+    """Extract text from an uploaded .txt, .pdf, or .docx file."""
+    return _extract_text_cached(file.getvalue(), file.name)
 
 def create_openai_client():
-    """Instantiate and return an OpenAI client with the API key."""
-    return OpenAI(api_key=st.session_state["api_key"])
+    """
+    Return the session's OpenAI client, reusing its HTTP connection pool across calls.
 
-# ---- Core Functions ----
-def generate_learning_objectives(faktabas: str) -> list:
+    A new client is created on first use and whenever the API key changes.
     """
-    Analyze the fact base and generate a specified number of learning objectives 
-    (lärandemål) along with a complete reference excerpt and up to 5 indicators each.
-    
-    Each learning objective must be formulated using one of Bloom's taxonomy verbs
-    ("Lista", "Återge", or "Redogör för"). The 'referens' field should contain a
-    full, coherent excerpt from the fact base – at least one complete paragraph (min. ~100 words)
-    – that directly supports the objective and its indicators.
+    key_hash = hashlib.sha256(st.session_state["api_key"].encode()).hexdigest()
+    if st.session_state.get("_openai_client_key") != key_hash:
+        previous = st.session_state.get("_openai_client")
+        if previous is not None:
+            previous.close()
+        st.session_state["_openai_client"] = OpenAI(api_key=st.session_state["api_key"])
+        st.session_state["_openai_client_key"] = key_hash
+    return st.session_state["_openai_client"]
 
-    Returns a JSON array.
+def create_async_client():
     """
-    client = create_openai_client()
-    text_length = len(faktabas)
-    num_goals = min(max(text_length // 1000, 3), 8)
+    Instantiate and return an async OpenAI client for concurrent requests.
+
+    Not kept in session state: its connection pool is tied to the event loop
+    of the asyncio.run call that uses it, so one client serves one batch.
+    """
+    return AsyncOpenAI(api_key=st.session_state["api_key"])
+
+def get_cached_response(payload: dict) -> tuple:
+    """
+    Look up a previous response for the given request payload.
+
+    Checks the in-session memo first (cheap reruns) and then the on-disk cache.
+    Returns (key, content); content is None on a cache miss.
+    """
+    key = llm_cache.make_key(payload)
+    memo = st.session_state.setdefault("_llm_responses", {})
+    if key in memo:
+        return key, memo[key]
+    cached = llm_cache.get(key)
+    if cached is not None:
+        memo[key] = cached["content"]
+        return key, cached["content"]
+    return key, None
+
+def store_cached_response(key: str, content: str):
+    """Store a successfully parsed response in both the session memo and on disk."""
+    st.session_state.setdefault("_llm_responses", {})[key] = content
+    llm_cache.set(key, {"content": content})
+
+def render_partial_items(placeholder, buf: str, shown: int, render_item, required=()) -> int:
+    """
+    Render the "items" of a partially streamed JSON reply that are complete.
+
+    Items missing any of the `required` keys are still being written and are
+    skipped. Only re-renders the placeholder when more elements have completed
+    than the `shown` count from the previous call. Returns the new count.
+    """
+    if placeholder is None:
+        return shown
+    try:
+        parsed = loads_partial_json(buf, Allow.ARR | Allow.OBJ)
+    except ValueError:
+        return shown
+    items = parsed.get("items") if isinstance(parsed, dict) else None
+    if not isinstance(items, list):
+        return shown
+    # The last element is still being written unless the buffer ends on its
+    # brace, possibly followed by the comma before the next element.
+    tail = buf.rstrip().rstrip(",").rstrip()
+    complete = items if tail.endswith("}") else items[:-1]
+    # A "}" inside a half-written string also ends the buffer; the parser then
+    # drops that field, so the item is caught by the required-keys check.
+    complete = [item for item in complete if isinstance(item, dict) and all(key in item for key in required)]
+    if len(complete) > shown:
+        with placeholder.container():
+            for item in complete:
+                render_item(item)
+    return max(len(complete), shown)
+
+def check_finish_reason(chunk):
+    """Raise a clear error if the completion was cut off by max_tokens."""
+    if chunk.choices and chunk.choices[0].finish_reason == "length":
+        raise ValueError("API:s svar blev avkortat (max_tokens nåddes).")
+
+def read_stream(stream, placeholder=None, render_item=None, required=()) -> str:
+    """Accumulate a streamed chat completion, rendering finished items as they arrive."""
+    buf = ""
+    shown = 0
+    for chunk in stream:
+        check_finish_reason(chunk)
+        delta = (chunk.choices[0].delta.content or "") if chunk.choices else ""
+        buf += delta
+        # An element can only have completed if its closing brace just arrived.
+        if "}" in delta:
+            shown = render_partial_items(placeholder, buf, shown, render_item, required)
+    return buf
+
+async def read_stream_async(stream, placeholder=None, render_item=None, required=()) -> str:
+    """Async counterpart of read_stream."""
+    buf = ""
+    shown = 0
+    async for chunk in stream:
+        check_finish_reason(chunk)
+        delta = (chunk.choices[0].delta.content or "") if chunk.choices else ""
+        buf += delta
+        if "}" in delta:
+            shown = render_partial_items(placeholder, buf, shown, render_item, required)
+    return buf
+
+def render_objective_preview(obj: dict):
+    """Show a streamed learning objective before the full result is ready."""
+    st.markdown("**Lärandemål:** " + obj.get("larandemal", ""))
+
+def render_mcq_preview(mcq: dict):
+    """Show a streamed MCQ before the full result is ready."""
+    st.markdown("**Fråga:** " + mcq.get("fraga", ""))
+
+def count_tokens(text: str) -> int:
+    """Return the number of gpt-4o-mini tokens in text."""
+    return len(ENC.encode_ordinary(text))
+
+MAX_FAKTABAS_TOKENS = 100_000
+HEAD_TOKENS = 50_000
+TAIL_TOKENS = 30_000
+
+@st.cache_data(max_entries=32)
+def fit_to_context(faktabas: str) -> str:
+    """
+    Cap the fact base to fit the model's context window.
+
+    Texts over MAX_FAKTABAS_TOKENS keep their first HEAD_TOKENS and last
+    TAIL_TOKENS tokens, so oversized uploads don't fail only after a full API call.
+    """
+    ids = ENC.encode_ordinary(faktabas)
+    if len(ids) <= MAX_FAKTABAS_TOKENS:
+        return faktabas
+    return ENC.decode(ids[:HEAD_TOKENS]) + "\n...\n" + ENC.decode(ids[-TAIL_TOKENS:])
+
+# ---- Retrieval ----
+EMBEDDING_MODEL = "text-embedding-3-small"
+EMBEDDING_BATCH_SIZE = 500  # keeps each request well under the per-request token limit
+CHUNK_TOKENS = 300
+RETRIEVAL_TOP_K = 3
+# Shorter fact bases are sent whole with each MCQ prompt: retrieval would save
+# little, and a shared fact base prefix lets prompt caching cover all MCQ calls.
+RETRIEVAL_MIN_TOKENS = 5_000
+# Longer fact bases are represented by a diverse sample of chunks when
+# generating learning objectives.
+LO_CONTEXT_TOKENS = 16_000
+SENTENCE_END = re.compile(r"(?<=[.!?])\s+")
+
+def _split_long_line(line: str, max_tokens: int) -> list[tuple[str, int]]:
+    """
+    Split a line into (text, tokens) pieces of at most ~max_tokens each.
+
+    Cuts fall between sentences, or between words for overlong sentences, so
+    the chunks stay readable when shown as references.
+    """
+    pieces = []
+    current = []
+    size = 0
+    for sentence in SENTENCE_END.split(line):
+        n = len(ENC.encode_ordinary(sentence))
+        if n <= max_tokens:
+            units = [(sentence, n)]
+        else:
+            units = [(word, len(ENC.encode_ordinary(word))) for word in sentence.split()]
+        for unit, n in units:
+            if current and size + n > max_tokens:
+                pieces.append((" ".join(current), size))
+                current = []
+                size = 0
+            current.append(unit)
+            size += n
+    if current:
+        pieces.append((" ".join(current), size))
+    return pieces
+
+def chunk_text(faktabas: str, max_tokens: int = CHUNK_TOKENS) -> list[str]:
+    """Split the fact base into chunks of whole lines, each at most ~max_tokens long."""
+    chunks = []
+    current = []
+    size = 0
+    for line in faktabas.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        n = len(ENC.encode_ordinary(line))
+        # Very long lines (e.g. .docx paragraphs, text files without line
+        # breaks) are split at sentence or word boundaries.
+        pieces = [(line, n)] if n <= max_tokens else _split_long_line(line, max_tokens)
+        for piece, n in pieces:
+            if current and size + n > max_tokens:
+                chunks.append("\n".join(current))
+                current = []
+                size = 0
+            current.append(piece)
+            size += n
+    if current:
+        chunks.append("\n".join(current))
+    return chunks
+
+@st.cache_data(max_entries=16)
+def embed_texts(_client, texts: list[str]) -> np.ndarray:
+    """Embed texts with EMBEDDING_MODEL; returns unit-length row vectors."""
+    vectors = []
+    for i in range(0, len(texts), EMBEDDING_BATCH_SIZE):
+        response = _client.embeddings.create(model=EMBEDDING_MODEL, input=texts[i:i + EMBEDDING_BATCH_SIZE])
+        vectors.extend(item.embedding for item in response.data)
+    matrix = np.asarray(vectors, dtype=np.float32)
+    return matrix / np.linalg.norm(matrix, axis=1, keepdims=True)
+
+@st.cache_data(max_entries=8)
+def chunk_and_embed(_client, faktabas: str) -> tuple[list[str], np.ndarray]:
+    """Chunk the fact base and embed every chunk; memoized on the fact base text."""
+    chunks = chunk_text(faktabas)
+    return chunks, embed_texts(_client, chunks)
+
+def build_index(faktabas: str):
+    """
+    Return the (chunks, vectors) index of the fact base, shared by both generators.
+
+    Returns None, with a warning, if the embedding call fails; callers then
+    fall back to working with the full text.
+    """
+    try:
+        return chunk_and_embed(create_openai_client(), faktabas)
+    except Exception as e:
+        st.warning(f"Kunde inte indexera faktabasen, hela texten används: {e}")
+        return None
+
+def rank_chunks(index: tuple, objs: list) -> np.ndarray:
+    """Return cosine similarities between each objective and every chunk (objectives x chunks)."""
+    queries = [
+        obj.get("larandemal", "") + "\n" + "\n".join(obj.get("indikatorer", []))
+        for obj in objs
+    ]
+    _, chunk_vectors = index
+    return embed_texts(create_openai_client(), queries) @ chunk_vectors.T
+
+def sample_diverse_chunks(index: tuple, max_tokens: int = LO_CONTEXT_TOKENS) -> str:
+    """
+    Pick a spread of chunks covering the whole fact base, within max_tokens.
+
+    Starts from the chunk closest to the centroid, then repeatedly adds the chunk
+    least similar to everything picked so far. Returned in document order.
+    """
+    chunks, vectors = index
+    sizes = [count_tokens(chunk) for chunk in chunks]
+    nearest = np.full(len(chunks), -np.inf, dtype=np.float32)
+    candidate = int(np.argmax(vectors @ vectors.mean(axis=0)))
+    selected = []
+    used = 0
+    while used + sizes[candidate] <= max_tokens:
+        selected.append(candidate)
+        used += sizes[candidate]
+        if len(selected) == len(chunks):
+            break
+        nearest = np.maximum(nearest, vectors @ vectors[candidate])
+        nearest[selected] = np.inf
+        candidate = int(np.argmin(nearest))
+    return "\n\n".join(chunks[i] for i in sorted(selected))
+
+def attach_references(objs: list, index) -> list:
+    """
+    Set each objective's "referens" to the fact base chunk that best matches it.
+
+    Quoting the source directly is more faithful, and much cheaper, than having
+    the model write the excerpt out again.
+    """
+    best = None
+    if objs:
+        try:
+            best = rank_chunks(index, objs).argmax(axis=1)
+        except Exception as e:
+            st.warning(f"Kunde inte hämta referenser ur faktabasen, referenserna saknas: {e}")
+    for i, obj in enumerate(objs):
+        obj["referens"] = index[0][best[i]] if best is not None else ""
+    return objs
+
+def retrieve_contexts(objs: list, faktabas: str, index) -> list[str]:
+    """
+    Return the fact base context to send with each learning objective's MCQ prompt.
+
+    For long fact bases, each objective gets only the RETRIEVAL_TOP_K chunks
+    most similar (cosine) to its lärandemål and indikatorer, in document order.
+    Short fact bases, a missing index or a failed embedding call fall back to
+    the full text.
+    """
+    if index is None or count_tokens(faktabas) < RETRIEVAL_MIN_TOKENS:
+        return [faktabas] * len(objs)
+    try:
+        scores = rank_chunks(index, objs)
+    except Exception as e:
+        st.warning(f"Kunde inte söka i faktabasen, hela texten används: {e}")
+        return [faktabas] * len(objs)
 
-    learning_objectives_prompt = f"""
-Analysera den nedanstående faktabasen och identifiera {num_goals} relevanta lärandemål baserade på innehållet.
+    chunks, _ = index
+    contexts = []
+    for row in scores:
+        top = sorted(np.argsort(row)[::-1][:RETRIEVAL_TOP_K])
+        contexts.append("\n\n".join(chunks[i] for i in top))
+    return contexts
+
+# ---- Prompts ----
+# Structured-output schemas. Strict mode requires an object root, so the
+# lists are wrapped as {"items": [...]}.
+LO_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "larandemal",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {
+                "items": {
+                    "type": "array",
+                    "items": {
+                        "type": "object",
+                        "properties": {
+                            "larandemal": {"type": "string"},
+                            "indikatorer": {"type": "array", "items": {"type": "string"}},
+                        },
+                        "required": ["larandemal", "indikatorer"],
+                        "additionalProperties": False,
+                    },
+                },
+            },
+            "required": ["items"],
+            "additionalProperties": False,
+        },
+    },
+}
+
+# Without a fact base index there are no chunks to quote, so the model writes
+# the "referens" excerpt itself.
+LO_RESPONSE_FORMAT_WITH_REFERENS = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "larandemal",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {
+                "items": {
+                    "type": "array",
+                    "items": {
+                        "type": "object",
+                        "properties": {
+                            "larandemal": {"type": "string"},
+                            "indikatorer": {"type": "array", "items": {"type": "string"}},
+                            "referens": {"type": "string"},
+                        },
+                        "required": ["larandemal", "indikatorer", "referens"],
+                        "additionalProperties": False,
+                    },
+                },
+            },
+            "required": ["items"],
+            "additionalProperties": False,
+        },
+    },
+}
+
+MCQ_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "mcqs",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {
+                "items": {
+                    "type": "array",
+                    "items": {
+                        "type": "object",
+                        "properties": {
+                            "fraga": {"type": "string"},
+                            "ratt_svar": {"type": "string"},
+                            "distraktorer": {"type": "array", "items": {"type": "string"}},
+                            "forklaring": {"type": "string"},
+                            "referens": {"type": "string"},
+                        },
+                        "required": ["fraga", "ratt_svar", "distraktorer", "forklaring", "referens"],
+                        "additionalProperties": False,
+                    },
+                },
+            },
+            "required": ["items"],
+            "additionalProperties": False,
+        },
+    },
+}
+
+def required_fields(response_format: dict) -> list:
+    """Return the keys every item of a structured-output schema must have."""
+    return response_format["json_schema"]["schema"]["properties"]["items"]["items"]["required"]
+
+LO_SYSTEM_PROMPT = (
+    "Du är expert på att skapa pedagogiska lärandemål och indikatorer enligt Bloom's taxonomi. "
+    "Följ anvisningarna noggrant."
+)
+
+LO_REFERENS_INSTRUCTION = """
+- "referens": Ett fullständigt, sammanhängande textavsnitt från faktabasen (minst 100 ord och upp till 200 ord) som tydligt visar hur lärandemålet och dess indikatorer stöds av texten. Inkludera en eller två kompletta stycken."""
+
+LO_PROMPT_TEMPLATE = """**Faktabas:**
+{faktabas}
+
+Analysera den ovanstående faktabasen och identifiera {num_goals} relevanta lärandemål baserade på innehållet.
 Varje lärandemål ska formuleras med ett verb enligt Bloom's taxonomi: "Lista", "Återge", eller "Redogör för".
 
 För varje lärandemål, ange följande fält:
 - "larandemal": En kort titel/formulerat lärandemål som innehåller ett av verben.
-- "indikatorer": En lista med upp till 5 stödord eller korta meningar.
-- "referens": Ett fullständigt, sammanhängande textavsnitt från faktabasen (minst 100 ord och upp till 200 ord) 
-  som tydligt visar hur lärandemålet och dess indikatorer stöds av texten. Inkludera en eller två kompletta stycken.
-
-Returnera endast ett JSON‐array i följande struktur (inga extra texter utanför JSON):
-[
-  {{
-    "larandemal": "Titel med Bloom-verb",
-    "indikatorer": ["Indikator 1", "Indikator 2", ...],
-    "referens": "Fullständig text som stödjer lärandemålet och indikatorerna"
-  }},
-  ...
-]
-
-**Faktabas:**
+- "indikatorer": En lista med upp till 5 stödord eller korta meningar.{referens_instruktion}
+
+Returnera ett JSON-objekt där fältet "items" innehåller lärandemålen i följande struktur:
+{{
+  "items": [
+    {{
+      "larandemal": "Titel med Bloom-verb",
+      "indikatorer": ["Indikator 1", "Indikator 2", ...]
+    }},
+    ...
+  ]
+}}
+"""
+
+MCQ_SYSTEM_PROMPT = (
+    "Du är expert på att skapa pedagogiska flervalsfrågor enligt Bloom's taxonomi. "
+    "Skapa frågor med attraktiva, utmanande distraktorer som är realistiska men inte uppenbara. "
+    "Inkludera ett fullständigt textavsnitt (minst 100 ord) som referens."
+)
+
+# The fact base and the static instructions come first and form a prefix shared
+# by every objective in a run, so OpenAI's prompt caching can reuse it; only the
+# objective-specific part goes last.
+MCQ_PROMPT_TEMPLATE = """**Faktabas:**
 {faktabas}
+
+Skapa 4 flervalsfrågor för det angivna lärandemålet med de angivna indikatorerna.
+För varje fråga, ange följande fält:
+- "fraga": En **välformulerad fråga** som inte kan besvaras enbart genom att känna igen nyckelord; testar förståelse genom att kräva analys jämförelse eller tillämpning av kunskap; gärna använder **ett scenario eller ett exempel** om det är relevant.
+- "ratt_svar": Det rätta svaret.
+- "distraktorer": En lista med 3 alternativa svar som är **Utmanande men trovärdiga**, dvs. varje distraktor ska vara baserad på vanliga missförstånd, nära korrekta tolkningar eller alternativ som verkar rimliga vid en snabb analys; **jämförbara i längd och komplexitet** med det rätta svaret, dvs. de ska inte vara avsevärt kortare eller enklare; **strategiskt utvalda för att testa förståelse**, t.ex. genom att använda ett felaktigt resonemang, en vanlig men felaktig förenkling eller en felaktig tillämpning av fakta.
+- "forklaring": En kort, men **pedagogisk och analytisk förklaring** som förklarar **varför det rätta svaret är korrekt**; förklarar **varför varje distraktor är fel**, gärna genom att peka ut specifika fel eller missförstånd. Förklaringen får inte använda termen 'distraktor', utan ska istället använda omskrivningar som 'de andra svaren' eller liknande.
+- "referens": En **klar och tydlig referens** (minst 100 ord) från faktabasen som Innehåller **både bakgrundsinformation och direkt stöd för svaret**; Gör det enkelt att förstå varför det rätta svaret är rätt.
+
+Returnera ett JSON-objekt där fältet "items" innehåller frågorna i följande form:
+{{
+  "items": [
+    {{
+      "fraga": "Frågetext",
+      "ratt_svar": "Det rätta svaret",
+      "distraktorer": ["Alternativ 1", "Alternativ 2", "Alternativ 3"],
+      "forklaring": "Förklaringstext",
+      "referens": "Fullständig text som visar var i faktabasen svaret framgår"
+    }},
+    ...
+  ]
+}}
+
+**Lärandemål:**
+{larandemal}
+
+**Indikatorer:**
+{ind_text}
 """
+
+# Completion budgets, from the expected size of the JSON replies. Each learning
+# objective is a title plus up to 5 short indicators; its reference is taken
+# from the index, or, without one, generated as a 100-200 word excerpt. Each
+# MCQ carries a question, four answers, an explanation and a 100+ word reference.
+LO_TOKENS_PER_GOAL = 250
+LO_TOKENS_PER_GOAL_WITH_REFERENS = 450
+MCQ_TOKENS_PER_QUESTION = 600
+MCQS_PER_OBJECTIVE = 4
+JSON_OVERHEAD_TOKENS = 200
+
+def lo_max_tokens(num_goals: int, with_referens: bool = False) -> int:
+    """Return max_tokens for a reply with num_goals learning objectives."""
+    per_goal = LO_TOKENS_PER_GOAL_WITH_REFERENS if with_referens else LO_TOKENS_PER_GOAL
+    return min(4096, num_goals * per_goal + JSON_OVERHEAD_TOKENS)
+
+MCQ_MAX_TOKENS = MCQS_PER_OBJECTIVE * MCQ_TOKENS_PER_QUESTION + JSON_OVERHEAD_TOKENS
+
+# ---- Core Functions ----
+def generate_learning_objectives(faktabas: str, index=None, placeholder=None) -> list:
+    """
+    Analyze the fact base and generate a specified number of learning objectives 
+    (lärandemål) along with a reference excerpt and up to 5 indicators each.
+    
+    Each learning objective must be formulated using one of Bloom's taxonomy verbs
+    ("Lista", "Återge", or "Redogör för"). The 'referens' field is filled with the
+    chunk of the fact base that best matches the objective (see attach_references),
+    or, when there is no index, written by the model.
+
+    `index` is the fact base's (chunks, vectors) from build_index. Fact bases
+    over LO_CONTEXT_TOKENS are sent as a diverse sample of chunks rather than
+    in full. Objectives are previewed in `placeholder` (an st.empty()) while
+    the response streams in. The reply is constrained by LO_RESPONSE_FORMAT
+    (LO_RESPONSE_FORMAT_WITH_REFERENS without an index); returns its "items" list.
+    """
+    client = create_openai_client()
+    num_tokens = count_tokens(faktabas)
+    num_goals = min(max(num_tokens // 750, 3), 8)
+    if index is not None and num_tokens > LO_CONTEXT_TOKENS:
+        faktabas = sample_diverse_chunks(index)
+
+    if index is None:
+        response_format, referens_instruktion = LO_RESPONSE_FORMAT_WITH_REFERENS, LO_REFERENS_INSTRUCTION
+    else:
+        response_format, referens_instruktion = LO_RESPONSE_FORMAT, ""
+
+    learning_objectives_prompt = LO_PROMPT_TEMPLATE.format(
+        faktabas=faktabas, num_goals=num_goals, referens_instruktion=referens_instruktion
+    )
+    payload = {
+        "model": "gpt-4o-mini",
+        "messages": [
+            {"role": "system", "content": LO_SYSTEM_PROMPT},
+            {"role": "user", "content": learning_objectives_prompt}
+        ],
+        "temperature": 0.1,
+        "response_format": response_format,
+    }
     try:
-        response = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[
-                {
-                    "role": "system",
-                    "content": (
-                        "Du är expert på att skapa pedagogiska lärandemål och indikatorer enligt Bloom's taxonomi. "
-                        "Följ anvisningarna noggrant och inkludera ett fullständigt textavsnitt (minst 100 ord) som referens."
-                    )
-                },
-                {"role": "user", "content": learning_objectives_prompt}
-            ],
-            temperature=0.1,
-            max_tokens=3000
-        )
-        raw_output = response.choices[0].message.content.strip()
-        if raw_output.startswith("```"):
-            lines = raw_output.splitlines()
-            if lines[0].startswith("```"):
-                lines = lines[1:]
-            if lines and lines[-1].startswith("```"):
-                lines = lines[:-1]
-            raw_output = "\n".join(lines).strip()
+        cache_key, content = get_cached_response(payload)
+        from_api = content is None
+        if from_api:
+            stream = client.chat.completions.create(**payload, max_tokens=lo_max_tokens(num_goals, index is None), stream=True)
+            content = read_stream(stream, placeholder, render_objective_preview, required_fields(response_format))
+        raw_output = content.strip()
 
         if not raw_output:
             st.error("API:s svar var tomt.")
             return []
 
         try:
-            learning_objectives = json.loads(raw_output)
+            learning_objectives = orjson.loads(raw_output)["items"]
         except Exception as json_err:
             st.error("Fel vid tolkning av JSON-svar från API: " + str(json_err))
             st.write("Rå output från API:", raw_output)
             return []
 
-        return learning_objectives
+        if from_api:
+            store_cached_response(cache_key, content)
+        if index is None:
+            return learning_objectives
+        return attach_references(learning_objectives, index)
     except Exception as e:
         st.error(f"Fel vid generering av lärandemål och indikatorer: {e}")
         return []
 
-def generate_mcq(larandemal: str, indikatorer: list, faktabas: str) -> list:
+def format_indikatorer(indikatorer: list) -> str:
+    """Format indicators as a markdown bullet list, for the MCQ prompt and the page."""
+    return "\n".join(f"- {ind}" for ind in indikatorer)
+
+async def generate_mcq_async(client, larandemal: str, ind_text: str, faktabas: str, placeholder=None) -> list:
     """
     Generate 4 multiple-choice questions (MCQs) for the given learning objective.
+    `ind_text` is its indicators, preformatted with format_indikatorer.
     For each question, include:
       - A carefully formulated question that does not directly reveal the correct answer.
       - Attractive, challenging, and plausible distractors that may be slightly longer.
@@ -141,80 +662,103 @@ def generate_mcq(larandemal: str, indikatorer: list, faktabas: str) -> list:
       - A complete reference excerpt (one or two full paragraphs, at least 100 words and up to 200 words)
         from the fact base that clearly shows where the correct answer is supported.
     
-    Return only a JSON array in the following structure (no extra text outside JSON):
+    The reply is constrained by MCQ_RESPONSE_FORMAT; returns its "items" list:
     [
-      {{
+      {
         "fraga": "Frågetext",
         "ratt_svar": "Det rätta svaret",
         "distraktorer": ["Alternativ 1", "Alternativ 2", "Alternativ 3"],
         "forklaring": "Förklaringstext",
         "referens": "Fullständig text som visar var i faktabasen svaret framgår"
-      }},
+      },
       ...
     ]
     """
-    client = create_openai_client()
+    mcq_prompt = MCQ_PROMPT_TEMPLATE.format(faktabas=faktabas, larandemal=larandemal, ind_text=ind_text)
 
-    mcq_prompt = f"""
-Skapa 4 flervalsfrågor för det angivna lärandemålet med de angivna indikatorerna.
-För varje fråga, ange följande fält:
-- "fraga": En **välformulerad fråga** som inte kan besvaras enbart genom att känna igen nyckelord; testar förståelse genom att kräva analys jämförelse eller tillämpning av kunskap; gärna använder **ett scenario eller ett exempel** om det är relevant.
-- "ratt_svar": Det rätta svaret.
-- "distraktorer": En lista med 3 alternativa svar som är **Utmanande men trovärdiga**, dvs. varje distraktor ska vara baserad på vanliga missförstånd, nära korrekta tolkningar eller alternativ som verkar rimliga vid en snabb analys; **jämförbara i längd och komplexitet** med det rätta svaret, dvs. de ska inte vara avsevärt kortare eller enklare; **strategiskt utvalda för att testa förståelse**, t.ex. genom att använda ett felaktigt resonemang, en vanlig men felaktig förenkling eller en felaktig tillämpning av fakta.
-- "forklaring": En kort, men **pedagogisk och analytisk förklaring** som förklarar **varför det rätta svaret är korrekt**; förklarar **varför varje distraktor är fel**, gärna genom att peka ut specifika fel eller missförstånd. Förklaringen får inte använda termen 'distraktor', utan ska istället använda omskrivningar som 'de andra svaren' eller liknande.
-- "referens": En **klar och tydlig referens** (minst 100 ord) från faktabasen som Innehåller **både bakgrundsinformation och direkt stöd för svaret**; Gör det enkelt att förstå varför det rätta svaret är rätt.
-
-Returnera endast ett JSON-array i följande form (inga extra texter utanför JSON):
-[
-  {{
-    "fraga": "Frågetext",
-    "ratt_svar": "Det rätta svaret",
-    "distraktorer": ["Alternativ 1", "Alternativ 2", "Alternativ 3"],
-    "forklaring": "Förklaringstext",
-    "referens": "Fullständig text som visar var i faktabasen svaret framgår"
-  }},
-  ...
-]
-
-**Lärandemål:**
-{larandemal}
-
-**Indikatorer:**
-{"\n".join(indikatorer)}
-
-**Faktabas:**
-{faktabas}
-"""
+    payload = {
+        "model": "gpt-4o-mini",
+        "messages": [
+            {"role": "system", "content": MCQ_SYSTEM_PROMPT},
+            {"role": "user", "content": mcq_prompt}
+        ],
+        "temperature": 0.1,
+        "response_format": MCQ_RESPONSE_FORMAT,
+    }
 
     try:
-        response = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[
-                {"role": "system", "content": (
-                    "Du är expert på att skapa pedagogiska flervalsfrågor enligt Bloom's taxonomi. "
-                    "Skapa frågor med attraktiva, utmanande distraktorer som är realistiska men inte uppenbara. "
-                    "Inkludera ett fullständigt textavsnitt (minst 100 ord) som referens."
-                )},
-                {"role": "user", "content": mcq_prompt}
-            ],
-            temperature=0.1,
-            max_tokens=2500
-        )
-        raw_output = response.choices[0].message.content.strip()
-        if raw_output.startswith("```"):
-            lines = raw_output.splitlines()
-            if lines[0].startswith("```"):
-                lines = lines[1:]
-            if lines and lines[-1].startswith("```"):
-                lines = lines[:-1]
-            raw_output = "\n".join(lines).strip()
-
-        mcqs = json.loads(raw_output)
+        cache_key, content = get_cached_response(payload)
+        from_api = content is None
+        if from_api:
+            stream = await client.chat.completions.create(**payload, max_tokens=MCQ_MAX_TOKENS, stream=True)
+            content = await read_stream_async(
+                stream, placeholder, render_mcq_preview, required_fields(MCQ_RESPONSE_FORMAT)
+            )
+        mcqs = orjson.loads(content)["items"]
+        # Only fresh replies are written back; re-storing a hit would reset its TTL.
+        if from_api:
+            store_cached_response(cache_key, content)
         return mcqs
     except Exception as e:
         st.error(f"Fel vid generering av MCQs: {e}")
         return []
 
+async def _indexed(i: int, coro):
+    """Await coro and return its result together with i, for use with as_completed."""
+    return i, await coro
+
+async def _gather_mcqs(objs: list, contexts: list, status=None) -> tuple:
+    """
+    Generate MCQs for all learning objectives concurrently.
+
+    `contexts` holds the fact base text to use for each objective (see retrieve_contexts).
+    If an st.status container is given, its label shows how many objectives are done.
+    Returns (mcqs keyed by lärandemål, list of lärandemål that got no MCQs).
+    """
+    client = create_async_client()
+    async with client:
+        names = [obj.get("larandemal", "") for obj in objs]
+        ind_texts = [format_indikatorer(obj.get("indikatorer", [])) for obj in objs]
+        placeholders = [st.empty() for _ in objs]
+        tasks = [
+            _indexed(i, generate_mcq_async(client, name, ind_text, context, placeholder))
+            for i, (name, ind_text, context, placeholder)
+            in enumerate(zip(names, ind_texts, contexts, placeholders))
+        ]
+        results = [[] for _ in objs]
+        for done, next_done in enumerate(asyncio.as_completed(tasks), start=1):
+            i, mcqs = await next_done
+            results[i] = mcqs
+            if status is not None:
+                status.update(label=f"Genererar flervalsfrågor ... {done}/{len(objs)} lärandemål klara")
+    for placeholder in placeholders:
+        placeholder.empty()
+    failed = [name for name, mcqs in zip(names, results) if not mcqs]
+    return dict(zip(names, results)), failed
+
+# ---- Rendering ----
+# Each result is rendered as one markdown block per column instead of one
+# element per heading and list item, which keeps the element tree that
+# Streamlit rebuilds on every rerun small.
+def format_objective(obj: dict) -> tuple:
+    """Return (reference, objective) markdown for a learning objective's two columns."""
+    reference = "**Referens i faktabas:**\n\n" + obj.get("referens", "")
+    indicators = format_indikatorer(obj.get("indikatorer", []))
+    objective = f"**Lärandemål:** {obj.get('larandemal', '')}\n\n**Indikatorer:**\n\n{indicators}"
+    return reference, objective
+
+def format_mcq(mcq: dict) -> tuple:
+    """Return (reference, question) markdown for an MCQ's two columns."""
+    reference = "**Referens i faktabasen:**\n\n" + mcq.get("referens", "")
+    distractors = "\n".join(f"- {d}" for d in mcq.get("distraktorer", []))
+    question = (
+        f"**Fråga:**\n\n{mcq.get('fraga', '')}\n\n"
+        f"**Rätt svar:**\n\n{mcq.get('ratt_svar', '')}\n\n"
+        f"**Distraktorer:**\n\n{distractors}\n\n"
+        f"**Förklaring:**\n\n{mcq.get('forklaring', '')}"
+    )
+    return reference, question
+
 # ---- Main Application Flow ----
 def main():
     api_key = get_api_key()
@@ -228,60 +772,70 @@ def main():
     if uploaded_file:
         faktabas = extract_text(uploaded_file)
         if faktabas:
-            st.session_state["faktabas"] = faktabas
+            fitted = fit_to_context(faktabas)
+            if len(fitted) < len(faktabas):
+                st.warning("Faktabasen är för lång och har kortats ned till början och slutet av texten.")
+            st.session_state["faktabas"] = fitted
+            # Embed each fact base once, not on every rerun. A failed build is
+            # stored as None too, so it is only retried for a new text (or after
+            # "Starta om") instead of on every button click.
+            index_key = hashlib.sha256(fitted.encode()).hexdigest()
+            if st.session_state.get("faktabas_index_key") != index_key:
+                st.session_state["faktabas_index"] = build_index(fitted)
+                st.session_state["faktabas_index_key"] = index_key
             st.success(f"Filen {uploaded_file.name} har laddats upp!")
         else:
             st.error("Kunde inte extrahera text från filen.")
 
     if "faktabas" in st.session_state and st.button("Generera lärandemål och indikatorer"):
         with st.spinner("Analyserar faktabasen och genererar lärandemål och indikatorer ..."):
-            learning_objectives = generate_learning_objectives(st.session_state["faktabas"])
+            preview = st.empty()
+            learning_objectives = generate_learning_objectives(
+                st.session_state["faktabas"], st.session_state.get("faktabas_index"), preview
+            )
+            preview.empty()
             st.session_state["larandemal_och_indikatorer"] = learning_objectives
 
     # Display Learning Objectives
     if "larandemal_och_indikatorer" in st.session_state and st.session_state["larandemal_och_indikatorer"]:
         st.subheader("Genererade lärandemål och indikatorer")
         for obj in st.session_state["larandemal_och_indikatorer"]:
+            reference, objective = format_objective(obj)
             col1, col2 = st.columns(2)
-            with col1:
-                st.markdown("**Referens i faktabas:**")
-                st.write(obj.get("referens", ""))
-            with col2:
-                st.markdown("**Lärandemål:** " + obj.get("larandemal", ""))
-                st.markdown("**Indikatorer:**")
-                for ind in obj.get("indikatorer", []):
-                    st.write(f"- {ind}")
+            col1.markdown(reference)
+            col2.markdown(objective)
             st.write("---")
 
         if st.button("Generera flervalsfrågor"):
-            with st.spinner("Genererar flervalsfrågor ..."):
-                mcqs_all = {}
-                for obj in st.session_state["larandemal_och_indikatorer"]:
-                    larandemal = obj.get("larandemal", "")
-                    indikatorer = obj.get("indikatorer", [])
-                    mcqs = generate_mcq(larandemal, indikatorer, st.session_state["faktabas"])
-                    mcqs_all[larandemal] = mcqs
-                st.session_state["mcqs"] = mcqs_all
+            # The calls run concurrently on this script thread, so the status
+            # label updates as each objective finishes and Streamlit's stop
+            # button still cancels the batch. Finished objectives are in the
+            # response cache, so clicking again only redoes the rest.
+            with st.status("Genererar flervalsfrågor ...", expanded=True) as status:
+                objs = st.session_state["larandemal_och_indikatorer"]
+                contexts = retrieve_contexts(objs, st.session_state["faktabas"], st.session_state.get("faktabas_index"))
+                # Streamlit runs the script in a thread without an event loop,
+                # so asyncio.run can safely create (and close) a fresh one.
+                st.session_state["mcqs"], failed = asyncio.run(_gather_mcqs(objs, contexts, status))
+                if failed:
+                    # Keep the box open: the errors are rendered inside it.
+                    status.update(
+                        label=f"Flervalsfrågor saknas för {len(failed)} av {len(objs)} lärandemål",
+                        state="error",
+                        expanded=True,
+                    )
+                else:
+                    status.update(label="Flervalsfrågorna är klara", state="complete", expanded=False)
 
     if "mcqs" in st.session_state:
         st.subheader("Genererade flervalsfrågor")
         for larandemal, mcq_list in st.session_state["mcqs"].items():
             st.markdown(f"### {larandemal}")
             for mcq in mcq_list:
+                reference, question = format_mcq(mcq)
                 col1, col2 = st.columns(2)
-                with col1:
-                    st.markdown("**Referens i faktabasen:**")
-                    st.write(mcq.get("referens", ""))
-                with col2:
-                    st.markdown("**Fråga:**")
-                    st.write(mcq.get("fraga", ""))
-                    st.markdown("**Rätt svar:**")
-                    st.write(mcq.get("ratt_svar", ""))
-                    st.markdown("**Distraktorer:**")
-                    for d in mcq.get("distraktorer", []):
-                        st.write(f"- {d}")
-                    st.markdown("**Förklaring:**")
-                    st.write(mcq.get("forklaring", ""))
+                col1.markdown(reference)
+                col2.markdown(question)
                 st.write("---")
 
 if __name__ == "__main__":
@@ -0,0 +1,30 @@
+"""On-disk cache for OpenAI chat completion responses.
+
+Entries are keyed by a SHA-256 digest of the request payload (model, messages,
+temperature, response_format) so identical prompts are answered without a new
+API call, and a changed output schema never reuses replies in the old shape.
+"""
+import hashlib
+import json
+
+import diskcache
+
+CACHE_DIR = "./.llm_cache"
+TTL_SECONDS = 7 * 24 * 60 * 60  # 7 days
+
+_cache = diskcache.Cache(CACHE_DIR)
+
+
+def make_key(payload: dict) -> str:
+    """Return a stable cache key for a chat completion request payload."""
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+
+
+def get(key: str) -> dict | None:
+    """Return the cached response for ``key``, or None on a miss."""
+    return _cache.get(key)
+
+
+def set(key: str, resp_dict: dict) -> None:
+    """Store ``resp_dict`` under ``key`` for TTL_SECONDS."""
+    _cache.set(key, resp_dict, expire=TTL_SECONDS)
@@ -0,0 +1,68 @@
+"""PDF text extraction, split across worker processes for larger documents.
+
+pdfplumber's layout analysis (pdfminer.six) is pure Python and holds the GIL,
+so pages are extracted in separate processes rather than threads. Each worker
+opens its own copy of the document and handles a contiguous page range, which
+keeps the page order intact.
+"""
+import io
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+
+import pdfplumber
+
+# Plain reading-order text is all we need: no layout reconstruction, and the
+# tolerances are passed explicitly so pdfplumber's defaults can't drift.
+EXTRACT_KWARGS = {"x_tolerance": 3, "y_tolerance": 3, "layout": False}
+
+MAX_WORKERS = 8
+# Measured on a 36-page PDF: ~85 ms per page sequentially, and ~0.55 s to start
+# a forkserver pool whose workers import pdfplumber and parse their own copy of
+# the document. Below these sizes the pool costs more than it saves.
+MIN_PAGES_FOR_POOL = 24
+MIN_PAGES_PER_WORKER = 8
+
+
+def _page_text(page) -> str | None:
+    """Extract one page's text, then drop its cached layout objects to bound memory."""
+    text = page.extract_text(**EXTRACT_KWARGS)
+    page.close()
+    return text
+
+
+def _extract_range(file_bytes: bytes, first: int, last: int) -> list[str | None]:
+    """Extract the text of pages first..last (1-based, inclusive)."""
+    with pdfplumber.open(io.BytesIO(file_bytes), pages=list(range(first, last + 1))) as pdf:
+        return [_page_text(page) for page in pdf.pages]
+
+
+def _pool_context():
+    """Return a forkserver context, or None on platforms without one (Windows)."""
+    # Streamlit's server is multi-threaded, and forking a threaded process can
+    # deadlock the children, so workers come from a clean forkserver instead.
+    if "forkserver" not in multiprocessing.get_all_start_methods():
+        return None
+    context = multiprocessing.get_context("forkserver")
+    # Import pdfplumber once in the server, so forked workers start warm. This
+    # replaces the default preload of __main__, which here is the Streamlit CLI.
+    context.set_forkserver_preload(["pdfplumber"])
+    return context
+
+
+def extract_pages(file_bytes: bytes) -> list[str | None]:
+    """Return the text of every page in order; None for pages without text."""
+    with pdfplumber.open(io.BytesIO(file_bytes)) as pdf:
+        num_pages = len(pdf.pages)
+        workers = min(MAX_WORKERS, os.cpu_count() or 1, num_pages // MIN_PAGES_PER_WORKER)
+        context = _pool_context()
+        if num_pages < MIN_PAGES_FOR_POOL or workers < 2 or context is None:
+            return [_page_text(page) for page in pdf.pages]
+
+    step = -(-num_pages // workers)  # ceil division
+    firsts = list(range(1, num_pages + 1, step))
+    lasts = [min(first + step - 1, num_pages) for first in firsts]
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context) as executor:
+        chunks = executor.map(_extract_range, repeat(file_bytes), firsts, lasts)
+        return [text for chunk in chunks for text in chunk]